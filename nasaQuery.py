@@ -1,11 +1,49 @@
+import asyncio
 import csv
-import json
+import os
+import random
+import re
+import shelve
 import sys
+import aiohttp
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    # orjson decodes JSON several times faster when it is installed
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
+# Reusing one pooled session so every request does not open a new connection,
+# throttled and temporarily failing requests are retried with backoff and any
+# other failed response raises an error
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(
+    pool_connections=32, pool_maxsize=64,
+    max_retries=Retry(total=5, backoff_factor=1,
+                      status_forcelist=(429, 500, 502, 503, 504))))
+SESSION.hooks["response"].append(
+    lambda response, *args, **kwargs: response.raise_for_status())
+
+# Limiting the number of requests in flight so the API does not throttle us
+MAX_CONCURRENT_REQUESTS = 64
+# Longest wait before a retry, the request keeps its slot while waiting
+MAX_RETRY_DELAY = 60
+REQUEST_TIMEOUT = aiohttp.ClientTimeout(total=30)
+# Metadata documents never change, so they are kept on disk between runs
+METADATA_CACHE_FILE = "nasa_metadata_cache"
+CSV_FILE_NAME = "nasa_ids.csv"
+# Matches file sizes such as "1234 kB" or "2.5 MB" from the image metadata
+IMAGE_SIZE_PATTERN = re.compile(r"([\d.]+)\s*(kB|MB|GB)")
+# Multiplier converting every supported unit into kB
+IMAGE_SIZE_UNITS = {"kB": 1, "MB": 1000, "GB": 1000000}
 
 
 def perform_nasa_api_query(search_term):
-    """Receives a search term and queries the nasa image and video library API for results
+    """Receives a search term and queries the nasa image and video library API
+    for image results, other media types are filtered out by the API
 
     Arguments:
         searchTerm {string} -- The term to search for in the API
@@ -16,10 +54,10 @@ def perform_nasa_api_query(search_term):
 
     # Storing API search URL in variable
     url = "https://images-api.nasa.gov/search"
-    query_string = {"q": search_term}
+    # Asking the API for images only so we don't page through videos and audio
+    query_string = {"q": search_term, "media_type": "image"}
     # Performing our network request and storing the response
-    response = requests.request("GET", url, params=query_string)
-    check_query_was_successful(response)
+    response = SESSION.get(url, params=query_string)
     return response
 
 
@@ -33,25 +71,10 @@ def perform_extra_url_query(url):
         Response object -- The response received from the NASA API
     """
 
-    response = requests.request("GET", url)
-    check_query_was_successful(response)
+    response = SESSION.get(url)
     return response
 
 
-def check_query_was_successful(response):
-    """Checks if the response status code was anythin except for 200,
-    meaning our query failed and there is an issue
-
-    Arguments:
-        response {Response object} -- The response from the NASA API
-    """
-
-    # Checking to see that our request was successful
-    if response.status_code != 200:
-        print("Status code is not 200, exiting")
-        sys.exit()
-
-
 def check_query_for_results(data):
     """Checks that the API query result returned more than 0 results to make
     sure we have data to work with
@@ -64,123 +87,281 @@ def check_query_for_results(data):
     """
 
     # Checking that our request returned actual results
-    if data["collection"]["metadata"]["total_hits"] == 0:
+    total_hits = data["collection"]["metadata"]["total_hits"]
+    if total_hits == 0:
         print("0 results were returned from query, please check your query")
         sys.exit()
-    return data["collection"]["metadata"]["total_hits"]
+    return total_hits
 
 
-def generate_items_array_from_data(data, total_items):
+def generate_items_array_from_data(data):
     """Iterates through all result pages returned from the NASA API and
-    generates an array of item object, the function will check for extra result
-    pages and add the results from those pages to the final array as well
+    generates an array of item object, the function follows the link to the
+    next result page until the last page is reached and adds the results from
+    those pages to the final array as well
 
     Arguments:
         data {Dictionary} -- A python dictionary containing the converted JSON data received from the API
-        totalItemsNumber {[integer]} -- The total number of results returned from the NASA API
 
     Returns:
         list -- A list containing all media results returned from the NASA API
     """
 
-    items = data["collection"]["items"]
-    # The number of items received from the result is not the total number
-    # of results, meaning there are more result pages
-    while(len(items) != total_items):
-        # Checking if there are more result pages
-        for link in data["collection"]["links"]:
-            # Checking if the result page is for a new result page or one
-            # we queried before
-            if link["rel"] == "next":
-                # The result page is one we didn't query yet, getting data
-                next_page_response = perform_extra_url_query(link["href"])
-                data = json.loads(next_page_response.text)
-                # Adding results from new page to our total results list
-                items += data["collection"]["items"]
+    collection = data["collection"]
+    items = list(collection["items"])
+    while True:
+        # Checking if there is another result page, the last page has no
+        # link to a next one
+        links = collection.get("links", [])
+        next_page_url = next((link["href"] for link in links
+                              if link["rel"] == "next"), None)
+        if next_page_url is None:
+            break
+        next_page_response = perform_extra_url_query(next_page_url)
+        collection = next_page_response.json()["collection"]
+        # Adding results from new page to our total results list
+        items.extend(collection["items"])
     return items
 
 
-def generate_final_array_from_items(items):
-    """Receives the list of item results retrieved from the API and checks the
-    file for images larger than 1000kb and stores their IDs and sizes in a list
+async def fetch_json(session, request_semaphore, url, tries=5):
+    """Performs an asynchronous GET request to the URL supplied and decodes the
+    JSON body of the response, retrying with exponential backoff when the
+    server throttles us or fails temporarily
 
-    The query is performed by checking the metadata.json file every image in
-    the API has and checking for the file size listed
+    Arguments:
+        session {ClientSession} -- The aiohttp session used to perform the request
+        request_semaphore {Semaphore} -- Limits the number of requests in flight
+        url {string} -- A URL directing to a JSON document from the NASA API
+
+    Keyword Arguments:
+        tries {integer} -- The number of attempts before giving up (default: {5})
+
+    Returns:
+        Dictionary or list -- The decoded JSON data received from the URL
+    """
+
+    async with request_semaphore:
+        for attempt in range(tries):
+            last_attempt = attempt == tries - 1
+            try:
+                async with session.get(url, timeout=REQUEST_TIMEOUT) as response:
+                    retryable = (response.status == 429
+                                 or 500 <= response.status < 600)
+                    if retryable and not last_attempt:
+                        await asyncio.sleep(get_retry_delay(response, attempt))
+                        continue
+                    response.raise_for_status()
+                    # The asset server does not always label JSON documents
+                    # as such, so the content type check is skipped
+                    return await response.json(content_type=None,
+                                               loads=json_loads)
+            except (aiohttp.ClientConnectionError, asyncio.TimeoutError):
+                # Network hiccup, trying again unless we ran out of attempts
+                if last_attempt:
+                    raise
+                await asyncio.sleep(get_retry_delay(None, attempt))
+
+
+def get_retry_delay(response, attempt):
+    """Calculates how long to wait before retrying a failed request, honoring
+    the Retry-After header when the server sends one up to MAX_RETRY_DELAY
 
     Arguments:
-        items {list} -- A list of item results retrieved from the API
+        response {ClientResponse} -- The failed response, or None if no response was received
+        attempt {integer} -- The number of the attempt that failed, starting from 0
 
     Returns:
-        list -- A list of dictionaries containing NASA IDs and file sizes for
-        images larger than 1000kb
+        float -- The number of seconds to wait
+    """
+
+    if response is not None:
+        retry_after = response.headers.get("Retry-After", "")
+        if retry_after.isdigit():
+            return min(float(retry_after), MAX_RETRY_DELAY)
+    # Exponential backoff with jitter so retries do not arrive all at once
+    return 2 ** attempt + random.random()
+
+
+async def generate_csv_file_from_items(items):
+    """Receives the list of item results retrieved from the API, checks the
+    file for images larger than 1000kb and writes their IDs and sizes to a
+    CSV file
+
+    The query is performed by checking the metadata.json file every image in
+    the API has and checking for the file size listed, all images are
+    processed concurrently instead of one after the other and every result is
+    handed to the CSV writer as soon as it is found
+
+    Arguments:
+        items {list} -- A list of item results retrieved from the API
     """
 
-    # Creating empty list for results
-    final_entries = []
-    nasa_id = ''
+    # Collecting the NASA ID and json collection URL of every result, a dict
+    # is used to skip results listed more than once while keeping their order
+    image_entries = {}
     for image in items:
+        href = image["href"]
         # Querying the data object in every result to check that the media
         # type is an image
         for data_obj in image["data"]:
-            if data_obj["media_type"] != "image":
-                # Image not found, skipping
-                pass
-            nasa_id = data_obj["nasa_id"]
-            print(nasa_id)
-            # Querying the json collection for the image
-            image_versions_response = perform_extra_url_query(image["href"])
-            data = json.loads(image_versions_response.text)
-            for item in data:
-                # Checking that the image has a corresponding metadata
-                # document to extract file size from
-                if "metadata.json" in item:
-                    csv_entry = get_image_metadata(
-                        item, final_entries, nasa_id)
-                    if csv_entry is not None:
-                        final_entries.append(csv_entry)
-
-    return final_entries
-
-
-def get_image_metadata(item, final_entries, nasa_id):
-    image_versions_response = perform_extra_url_query(item)
-    # Getting image metadata from metadata file
-    imageMetadata = json.loads(image_versions_response.text)
-    # Checking that metadata file lists a FileSize property
-    if "File:FileSize" in imageMetadata:
-        # image_raw_size is the size represented with a unit (i.e kb/mb...)
-        image_raw_size = imageMetadata["File:FileSize"]
-        return check_image_size(image_raw_size, final_entries, nasa_id)
-
-
-def check_image_size(image_raw_size, final_entries, nasa_id):
-    # Checking if file size is listed in kB and is larger than 1000 kB
-    if "kB" in image_raw_size:
-        image_size = int(image_raw_size.split(" ")[0])
-        if image_size > 1000:
-            # File larger than 1000 kB, saving in array
-            return {"Nasa_id": nasa_id, "kb": image_size}
-    # Checking if file size is listed in MB and is larger than 1000 kB
-    elif "MB" in image_raw_size:
-        image_size = int(float(image_raw_size.split(" ")[0])*1000)
-        if image_size > 1000:
-            # File larger than 1000 kb, saving in array
-            return {"Nasa_id": nasa_id, "kb": image_size}
-
-
-def generate_csv_file_from_final_array(final_entries):
-    """Writes a CSV file containing the results from the NASA API
+            if data_obj.get("media_type") != "image":
+                # Image not found, skipping, the API should already filter
+                # these out but we make sure
+                continue
+            image_entries[(data_obj["nasa_id"], href)] = None
+
+    csv_queue = asyncio.Queue()
+    # Metadata requests in flight keyed by their URL, shared between images
+    # pointing at the same document
+    metadata_requests = {}
+    request_semaphore = asyncio.Semaphore(MAX_CONCURRENT_REQUESTS)
+    connector = aiohttp.TCPConnector(limit_per_host=64)
+    # Writing to a temporary file so a failed run keeps the previous results
+    temp_file_name = CSV_FILE_NAME + ".tmp"
+    try:
+        with open(temp_file_name, 'w', newline='', buffering=1 << 20) as csv_file, \
+                shelve.open(METADATA_CACHE_FILE) as metadata_cache:
+            writer = csv.writer(csv_file)
+            writer.writerow(('Nasa_id', "kb"))
+            writer_task = asyncio.create_task(
+                write_csv_rows_from_queue(csv_queue, writer))
+            try:
+                async with aiohttp.ClientSession(connector=connector) as session:
+                    # Processing every image at once, each image moves on to
+                    # its metadata document as soon as its own json
+                    # collection arrives
+                    await asyncio.gather(
+                        *(process_one_image(session, request_semaphore,
+                                            metadata_cache, metadata_requests,
+                                            csv_queue, nasa_id, href)
+                          for nasa_id, href in image_entries))
+                # Telling the writer there are no more results and waiting
+                # for it to write everything it received
+                await csv_queue.put(None)
+                await writer_task
+            finally:
+                writer_task.cancel()
+    except BaseException:
+        os.remove(temp_file_name)
+        raise
+    os.replace(temp_file_name, CSV_FILE_NAME)
+
+
+async def write_csv_rows_from_queue(csv_queue, writer):
+    """Writes every result placed in the queue to the CSV file until None is
+    received, meaning there are no more results
 
     Arguments:
-        finalArr {list} -- An array containing dictionaries of NASA IDs and file sizes
+        csv_queue {Queue} -- A queue of dictionaries containing NASA IDs and file sizes
+        writer {csv writer} -- The writer of the open CSV file
     """
 
-    with open('nasa_ids.csv', 'w', newline='') as csv_file:
-        field_names = ['Nasa_id', "kb"]
-        writer = csv.DictWriter(csv_file, fieldnames=field_names)
+    while True:
+        entry = await csv_queue.get()
+        if entry is None:
+            break
+        # Writing plain rows instead of dictionaries skips the field lookups
+        writer.writerow((entry["Nasa_id"], entry["kb"]))
 
-        writer.writeheader()
-        writer.writerows(final_entries)
+
+async def process_one_image(session, request_semaphore, metadata_cache,
+                            metadata_requests, csv_queue, nasa_id, href):
+    """Queries the json collection of a single image for its metadata document
+    and checks the file size listed in it, images larger than 1000kb are
+    placed in the queue for the CSV writer
+
+    Arguments:
+        session {ClientSession} -- The aiohttp session used to perform the requests
+        request_semaphore {Semaphore} -- Limits the number of requests in flight
+        metadata_cache {Shelf} -- Decoded metadata documents keyed by their URL
+        metadata_requests {Dictionary} -- Metadata requests in flight keyed by their URL
+        csv_queue {Queue} -- The queue feeding the CSV writer
+        nasa_id {string} -- The NASA ID of the image
+        href {string} -- The URL of the json collection of the image
+    """
+
+    print(nasa_id)
+    # Querying the json collection for the image
+    data = await fetch_json(session, request_semaphore, href)
+    for item in data:
+        # Checking that the image has a corresponding metadata document to
+        # extract file size from, every image has only one so there is no
+        # need to keep looking
+        if item.endswith("metadata.json"):
+            csv_entry = await get_image_metadata(
+                session, request_semaphore, metadata_cache, metadata_requests,
+                item, nasa_id)
+            if csv_entry is not None:
+                await csv_queue.put(csv_entry)
+            break
+
+
+async def get_image_metadata(session, request_semaphore, metadata_cache,
+                             metadata_requests, item, nasa_id):
+    """Fetches the metadata document of an image and checks its file size, the
+    document is only requested if it is not already in the on-disk cache or
+    being requested for another image
+
+    Arguments:
+        session {ClientSession} -- The aiohttp session used to perform the request
+        request_semaphore {Semaphore} -- Limits the number of requests in flight
+        metadata_cache {Shelf} -- Decoded metadata documents keyed by their URL
+        metadata_requests {Dictionary} -- Metadata requests in flight keyed by their URL
+        item {string} -- The URL of the metadata.json file of the image
+        nasa_id {string} -- The NASA ID of the image
+
+    Returns:
+        Dictionary -- The NASA ID and file size of the image if it is larger
+        than 1000kb, None otherwise
+    """
+
+    # Getting image metadata from the cache, or from the metadata file if we
+    # never fetched it before
+    imageMetadata = metadata_cache.get(item)
+    if imageMetadata is None:
+        request = metadata_requests.get(item)
+        if request is None:
+            # First image pointing at this document, requesting it and
+            # letting other images wait on the same request
+            request = asyncio.ensure_future(
+                fetch_json(session, request_semaphore, item))
+            metadata_requests[item] = request
+            imageMetadata = await request
+            metadata_cache[item] = imageMetadata
+            # Later images read the document from the cache, so the request
+            # no longer needs to hold on to it
+            metadata_requests.pop(item, None)
+        else:
+            imageMetadata = await request
+    # Checking that metadata file lists a FileSize property, image_raw_size
+    # is the size represented with a unit (i.e kb/mb...)
+    image_raw_size = imageMetadata.get("File:FileSize")
+    if image_raw_size:
+        return check_image_size(image_raw_size, nasa_id)
+
+
+def check_image_size(image_raw_size, nasa_id):
+    """Parses the file size listed in the image metadata and checks that the
+    image is larger than 1000kb
+
+    Arguments:
+        image_raw_size {string} -- The size represented with a unit (i.e kB/MB...)
+        nasa_id {string} -- The NASA ID of the image
+
+    Returns:
+        Dictionary -- The NASA ID and file size in kb of the image if it is
+        larger than 1000kb, None otherwise
+    """
+
+    match = IMAGE_SIZE_PATTERN.match(image_raw_size)
+    # Sizes listed in bytes are below 1000kb and other formats cannot be parsed
+    if match is None:
+        return None
+    image_size = int(float(match.group(1)) * IMAGE_SIZE_UNITS[match.group(2)])
+    if image_size > 1000:
+        # File larger than 1000 kb, saving in array
+        return {"Nasa_id": nasa_id, "kb": image_size}
 
 
 def main():
@@ -189,20 +370,18 @@ def main():
 
     initial_api_response = perform_nasa_api_query("Ilan Ramon")
 
-    # Storing the response text as JSON for easy manipulation and further querying
-    data = json.loads(initial_api_response.text)
+    # Decoding the response body as JSON for easy manipulation and further querying
+    data = initial_api_response.json()
 
     totalItemsNumber = check_query_for_results(data)
 
     print("Total number of items from query: {0}".format(totalItemsNumber))
 
-    items = generate_items_array_from_data(data, totalItemsNumber)
+    items = generate_items_array_from_data(data)
     # Storing image results in a JSON object array
     print("Number of items in array: {0}".format(len(items)))
 
-    final_entries = generate_final_array_from_items(items)
-
-    generate_csv_file_from_final_array(final_entries)
+    asyncio.run(generate_csv_file_from_items(items))
 
     print("Finished generating CSV file")
 